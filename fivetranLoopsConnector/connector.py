@@ -1,17 +1,49 @@
 import time
-import json
+import random
 import csv
 import io
-import urllib.request
+from urllib.parse import quote
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import re
 import datetime
+import functools
+import threading
+import http.cookiejar
 
 # Fivetran Connector SDK import
 from fivetran_connector_sdk import Connector
 from fivetran_connector_sdk import Operations as op
 from fivetran_connector_sdk import Logging as log
 
+# Shared session so every call to app.loops.so reuses one keep-alive connection.
+# Idempotent requests are retried on gateway errors; POSTs are never retried.
+_SESSION = requests.Session()
+_SESSION.headers.update({"content-type": "application/json"})
+# Never store Set-Cookie responses; the Loops cookie is sent explicitly per request
+_SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504], raise_on_status=False)
+))
+
+# Export polling backs off exponentially from 1s up to 30s, giving up after an hour
+_POLL_BASE_SECONDS = 1
+_POLL_CAP_SECONDS = 30
+_POLL_MAX_WAIT_SECONDS = 60 * 60
+
+# Patterns used to turn Loops field names into SQL-safe column names
+_CAMEL_BOUNDARY = re.compile(r'(?<!^)(?=[A-Z])')
+_NON_ALNUM = re.compile(r'[^a-zA-Z0-9]')
+
+# Custom fields per API key, so schema() and update() in one sync share a single fetch
+_CUSTOM_FIELDS_TTL_SECONDS = 10 * 60
+_CUSTOM_FIELDS_CACHE = {}
+_CUSTOM_FIELDS_LOCK = threading.Lock()
+
 def wait(seconds):
     """Simple wait utility (sleep)."""
     time.sleep(seconds)
@@ -23,22 +55,19 @@ def fetch_loops_export(session_cookie):
     """
     log.info("Requesting Loops export creation...")
 
-    export_resp = requests.post(
+    export_resp = _SESSION.post(
         "https://app.loops.so/api/trpc/lists.exportContacts",
-        headers={
-            "content-type": "application/json",
-            "cookie": session_cookie
-        },
-        json={
+        headers={"cookie": session_cookie},
+        data=orjson.dumps({
             "json": {
                 "filter": None,
                 "mailingListId": ""
             }
-        }
+        })
     )
     export_resp.raise_for_status()
 
-    export_data = export_resp.json().get("result", {}).get("data", {})
+    export_data = orjson.loads(export_resp.content).get("result", {}).get("data", {})
     export_id = export_data.get("json", {}).get("id")
     if not export_id:
         log.severe("Could not initiate Loops export – missing export ID.")
@@ -53,39 +82,44 @@ def fetch_loops_export(session_cookie):
             "id": export_id
         }
     }
-    encoded_params = urllib.request.quote(json.dumps(check_params))
+    # The status URL only depends on the export ID, so build it once
+    encoded_params = quote(orjson.dumps(check_params), safe="")
     check_url = f"https://app.loops.so/api/trpc/audienceDownload.getAudienceDownload?input={encoded_params}"
 
+    deadline = time.monotonic() + _POLL_MAX_WAIT_SECONDS
+    attempt = 0
+
     while status != "Complete":
-        wait(5)
+        if time.monotonic() >= deadline:
+            log.severe(f"Loops export {export_id} did not complete within {_POLL_MAX_WAIT_SECONDS} seconds.")
+            raise TimeoutError(f"Loops export {export_id} did not complete within {_POLL_MAX_WAIT_SECONDS} seconds.")
+
+        # Exponential backoff with ±50% jitter
+        delay = min(_POLL_CAP_SECONDS, _POLL_BASE_SECONDS * 2 ** attempt)
+        wait(delay * (0.5 + random.random()))
+        attempt += 1
         log.info("Checking Loops export status...")
 
-        poll_resp = requests.get(
+        poll_resp = _SESSION.get(
             check_url,
-            headers={
-                "content-type": "application/json",
-                "cookie": session_cookie
-            }
+            headers={"cookie": session_cookie}
         )
         poll_resp.raise_for_status()
 
-        poll_data = poll_resp.json().get("result", {}).get("data", {})
+        poll_data = orjson.loads(poll_resp.content).get("result", {}).get("data", {})
         status = poll_data.get("json", {}).get("status", None)
         log.info(f"Current export status: {status}")
 
     # 3. Request signed S3 download URL
     log.info("Export is complete! Retrieving the presigned download URL...")
-    sign_resp = requests.post(
+    sign_resp = _SESSION.post(
         "https://app.loops.so/api/trpc/audienceDownload.signs3Url",
-        headers={
-            "content-type": "application/json",
-            "cookie": session_cookie
-        },
-        json={"json": {"id": export_id}}
+        headers={"cookie": session_cookie},
+        data=orjson.dumps({"json": {"id": export_id}})
     )
     sign_resp.raise_for_status()
 
-    s3_data = sign_resp.json().get("result", {}).get("data", {})
+    s3_data = orjson.loads(sign_resp.content).get("result", {}).get("data", {})
     download_url = s3_data.get("json", {}).get("presignedUrl")
     if not download_url:
         log.severe("Could not retrieve presigned download URL for Loops export.")
@@ -95,17 +129,27 @@ def fetch_loops_export(session_cookie):
 
 def download_loops_csv(download_url):
     """
-    Downloads the CSV from the Loops presigned URL, returns it as in-memory data.
+    Opens a streaming download of the CSV from the Loops presigned URL.
+    Returns a text stream that is decoded as it is read.
     """
     log.info("Downloading Loops CSV file...")
-    resp = requests.get(download_url)
-    resp.raise_for_status()
-    return resp.content  # raw bytes
+    resp = requests.get(download_url, stream=True)
+    try:
+        resp.raise_for_status()
+    except Exception:
+        # A streamed response holds its connection until closed
+        resp.close()
+        raise
+    # Let urllib3 undo any gzip/deflate transfer encoding while streaming
+    resp.raw.decode_content = True
+    # urllib3 closes the response itself at EOF, which makes TextIOWrapper fail
+    # before it has handed out its buffered text; leave closing to the caller
+    resp.raw.auto_close = False
+    return io.TextIOWrapper(resp.raw, encoding="utf-8", errors="ignore", newline="")
 
 def camel_to_snake_case(name):
     """Convert camelCase to snake_case."""
-    pattern = re.compile(r'(?<!^)(?=[A-Z])')
-    return pattern.sub('_', name).lower()
+    return _CAMEL_BOUNDARY.sub('_', name).lower()
 
 def sanitize_sql_name(name):
     """
@@ -115,13 +159,14 @@ def sanitize_sql_name(name):
     - Converting to lowercase
     """
     # Replace any non-alphanumeric character with underscore
-    sanitized = re.sub(r'[^a-zA-Z0-9]', '_', name)
+    sanitized = _NON_ALNUM.sub('_', name)
     # Ensure it doesn't start with a number
     if sanitized[0].isdigit():
         sanitized = 'f_' + sanitized
     # Convert to lowercase
     return sanitized.lower()
 
+@functools.lru_cache(maxsize=None)
 def normalize_field_name(field_name):
     """
     Transform a field name into a normalized SQL-safe format by:
@@ -135,10 +180,17 @@ def fetch_custom_fields(api_key):
     """
     Fetches custom fields from Loops API.
     Returns a dictionary of field names and their types.
+    Results are cached per API key for a few minutes.
     """
+    with _CUSTOM_FIELDS_LOCK:
+        cached = _CUSTOM_FIELDS_CACHE.get(api_key)
+        if cached and cached[0] > time.monotonic():
+            log.info("Using cached custom fields from Loops API")
+            return cached[1]
+
     log.info("Fetching custom fields from Loops API...")
 
-    resp = requests.get(
+    resp = _SESSION.get(
         "https://app.loops.so/api/v1/contacts/customFields",
         headers={
             "Authorization": f"Bearer {api_key}"
@@ -146,7 +198,7 @@ def fetch_custom_fields(api_key):
     )
     resp.raise_for_status()
 
-    custom_fields = resp.json()
+    custom_fields = orjson.loads(resp.content)
     field_types = {}
 
     # Map Loops types to Fivetran types
@@ -172,6 +224,9 @@ def fetch_custom_fields(api_key):
         }
         field_mapping[original_key] = normalized_key
 
+    with _CUSTOM_FIELDS_LOCK:
+        _CUSTOM_FIELDS_CACHE[api_key] = (time.monotonic() + _CUSTOM_FIELDS_TTL_SECONDS, (field_types, field_mapping))
+
     return field_types, field_mapping
 
 def schema(configuration):
@@ -217,6 +272,26 @@ def sanitize_datetime(date_str):
     """
     if not date_str:
         return None
+
+    # Fast path for the exact shape Loops normally sends, e.g. 2024-01-31T12:00:00.000Z,
+    # validated with the C-implemented fromisoformat instead of strptime. Every separator
+    # is pinned so the more lenient fromisoformat can't accept what strptime would reject.
+    if (
+        len(date_str) == 24
+        and date_str[4] == '-'
+        and date_str[7] == '-'
+        and date_str[10] == 'T'
+        and date_str[13] == ':'
+        and date_str[16] == ':'
+        and date_str[19] == '.'
+        and date_str[23] == 'Z'
+    ):
+        normalized = date_str[:23] + '+00:00'
+        try:
+            datetime.datetime.fromisoformat(normalized)
+            return normalized
+        except ValueError:
+            pass  # Fall through to the full checks below for a proper warning
         
     try:
         # Handle special case with extreme future dates that have leading +
@@ -237,6 +312,17 @@ def sanitize_datetime(date_str):
         log.warning(f"Invalid datetime format: {date_str}, error: {str(e)}")
         return None
 
+# Raw CSV values treated as true for BOOLEAN columns; everything else is false
+_TRUE_SET = frozenset({"true", "True", "TRUE", "t", "T", "1", "yes", "Yes", "YES"})
+
+# Converters from raw CSV values to column values, keyed by Fivetran type
+_COERCERS = {
+    "BOOLEAN": _TRUE_SET.__contains__,
+    "DOUBLE": lambda value: float(value) if value else None,
+    "UTC_DATETIME": sanitize_datetime,
+    "STRING": str
+}
+
 def update(configuration, state):
     """
     Main data sync function.
@@ -258,100 +344,91 @@ def update(configuration, state):
     # Get download URL
     download_url = fetch_loops_export(session_cookie)
 
-    # 2. Download CSV in-memory
-    csv_bytes = download_loops_csv(download_url)
-
-    # 3. Parse CSV
-    log.info("Parsing the CSV from Loops export...")
-    
-    # Process in chunks using a file-like object
-    csv_file = io.StringIO(csv_bytes.decode("utf-8", errors="ignore"))
-    reader = csv.reader(csv_file)
-    
-    # Get headers and map to indices
-    headers = next(reader)
-    field_indices = {}
-    
-    # Map standard fields (case-insensitive)
-    standard_mapping = {
-        "email": "email",
-        "firstName": "first_name",
-        "lastName": "last_name",
-        "createdAt": "created_at",
-        "updatedAt": "updated_at",
-        "unsubscribed": "unsubscribed",
-        "userGroup": "user_group"
-    }
-    
-    for original, sanitized in standard_mapping.items():
-        if original in headers:
-            field_indices[sanitized] = headers.index(original)
-    
-    # Map custom fields using the field mapping
-    for original_name, sanitized_name in field_mapping.items():
-        if original_name in headers:
-            field_indices[sanitized_name] = headers.index(original_name)
-    
-    log.info(f"Found {len(field_indices)} fields in CSV")
-    
-    # Process in batches of 1000 records
-    batch_size = 1000
-    current_batch = []
-    total_records = 0
-    
-    for row in reader:
-        # Start with standard fields
-        record = {
-            "email": row[field_indices["email"]] if "email" in field_indices else "",
-            "first_name": row[field_indices["first_name"]] if "first_name" in field_indices else "",
-            "last_name": row[field_indices["last_name"]] if "last_name" in field_indices else "",
-            "created_at": sanitize_datetime(row[field_indices["created_at"]] if "created_at" in field_indices and row[field_indices["created_at"]] else None),
-            "updated_at": sanitize_datetime(row[field_indices["updated_at"]] if "updated_at" in field_indices and row[field_indices["updated_at"]] else None),
-            "unsubscribed": row[field_indices["unsubscribed"]].lower() == "true" if "unsubscribed" in field_indices else False,
-            "user_group": row[field_indices["user_group"]] if "user_group" in field_indices else ""
+    # 2. Stream the CSV download; closing it on every exit path releases the S3 connection
+    with download_loops_csv(download_url) as csv_file:
+        # 3. Parse CSV as it arrives
+        log.info("Parsing the CSV from Loops export...")
+        reader = csv.reader(csv_file)
+        
+        # Get headers and map to indices
+        headers = next(reader)
+        field_indices = {}
+        
+        # Map standard fields (case-insensitive)
+        standard_mapping = {
+            "email": "email",
+            "firstName": "first_name",
+            "lastName": "last_name",
+            "createdAt": "created_at",
+            "updatedAt": "updated_at",
+            "unsubscribed": "unsubscribed",
+            "userGroup": "user_group"
         }
         
-        # Add custom fields
-        for sanitized_name, info in custom_fields.items():
-            if sanitized_name in field_indices:
-                value = row[field_indices[sanitized_name]]
-                field_type = info["type"]
-                if field_type == "BOOLEAN":
-                    record[sanitized_name] = value.lower() == "true" if value else False
-                elif field_type == "DOUBLE":
-                    record[sanitized_name] = float(value) if value else None
-                elif field_type == "UTC_DATETIME":
-                    record[sanitized_name] = sanitize_datetime(value)
-                else:  # STRING
-                    record[sanitized_name] = value
+        for original, sanitized in standard_mapping.items():
+            if original in headers:
+                field_indices[sanitized] = headers.index(original)
+        
+        # Map custom fields using the field mapping
+        for original_name, sanitized_name in field_mapping.items():
+            if original_name in headers:
+                field_indices[sanitized_name] = headers.index(original_name)
+        
+        log.info(f"Found {len(field_indices)} fields in CSV")
+
+        # Resolve standard column positions once; -1 marks a column missing from the export
+        email_i, first_name_i, last_name_i, created_at_i, updated_at_i, unsubscribed_i, user_group_i = (
+            field_indices.get(sanitized, -1) for sanitized in standard_mapping.values()
+        )
+
+        # Resolve each custom field to its column index and converter once, up front
+        custom_plan = [
+            (sanitized_name, field_indices[sanitized_name], _COERCERS[info["type"]])
+            for sanitized_name, info in custom_fields.items()
+            if sanitized_name in field_indices
+        ]
         
-        current_batch.append(record)
+        # Checkpoint in batches of 10,000 records
+        batch_size = 10_000
+        total_records = 0
+        upsert = op.upsert
+        # One state dict for the whole sync; checkpoint() serializes it immediately
+        sync_state = {"last_sync": time.time(), "records_processed": 0}
         
-        # When we reach batch_size, yield the batch and checkpoint
-        if len(current_batch) >= batch_size:
-            total_records += len(current_batch)
-            log.info(f"Processing batch of {len(current_batch)} records (total processed: {total_records})")
+        for row in reader:
+            # Start with standard fields
+            record = {
+                "email": row[email_i] if email_i >= 0 else "",
+                "first_name": row[first_name_i] if first_name_i >= 0 else "",
+                "last_name": row[last_name_i] if last_name_i >= 0 else "",
+                "created_at": sanitize_datetime(row[created_at_i]) if created_at_i >= 0 else None,
+                "updated_at": sanitize_datetime(row[updated_at_i]) if updated_at_i >= 0 else None,
+                "unsubscribed": row[unsubscribed_i] in _TRUE_SET if unsubscribed_i >= 0 else False,
+                "user_group": row[user_group_i] if user_group_i >= 0 else ""
+            }
             
-            # Yield each record in the batch
-            for r in current_batch:
-                yield op.upsert("audience", r)
+            # Add custom fields
+            for sanitized_name, index, coerce in custom_plan:
+                record[sanitized_name] = coerce(row[index])
             
-            # Checkpoint after each batch
-            yield op.checkpoint(state={"last_sync": time.time(), "records_processed": total_records})
+            # Upserts are yielded as rows are parsed, so no batch list is kept around
+            yield upsert("audience", record)
+            total_records += 1
             
-            # Clear the batch
-            current_batch = []
+            # Checkpoint after each full batch
+            if total_records % batch_size == 0:
+                log.info(f"Processed batch of {batch_size} records (total processed: {total_records})")
+                sync_state["records_processed"] = total_records
+                yield op.checkpoint(state=sync_state)
     
-    # Process any remaining records
-    if current_batch:
-        total_records += len(current_batch)
-        log.info(f"Processing final batch of {len(current_batch)} records (total processed: {total_records})")
-        
-        for r in current_batch:
-            yield op.upsert("audience", r)
+    # Log any remaining partial batch
+    if total_records % batch_size:
+        log.info(f"Processed final batch of {total_records % batch_size} records (total processed: {total_records})")
     
     # Final checkpoint
-    yield op.checkpoint(state={"last_sync": time.time(), "records_processed": total_records})
+    sync_state["last_sync"] = time.time()
+    sync_state["records_processed"] = total_records
+    yield op.checkpoint(state=sync_state)
     
     log.info(f"Completed processing {total_records} total records")
 
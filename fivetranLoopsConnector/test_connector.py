@@ -0,0 +1,87 @@
+import csv
+import http.server
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+import connector
+
+connector.log.LOG_LEVEL = connector.log.Level.SEVERE
+
+
+class _CsvHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a fixed CSV body with a Content-Length, like the S3 presigned URL."""
+
+    status = 200
+    body = b""
+
+    def do_GET(self):
+        self.send_response(self.status)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.send_header("Set-Cookie", "loops_session=abc; Path=/")
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadLoopsCsvTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _CsvHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/audience.csv"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        _CsvHandler.status = 200
+
+    def test_reads_streamed_body_to_eof(self):
+        row_count = 100_000
+        lines = ["email,firstName,notes"]
+        lines += [f'user{i}@example.com,Name {i},"note, {i}"' for i in range(row_count)]
+        _CsvHandler.body = ("\n".join(lines) + "\n").encode("utf-8")
+
+        with connector.download_loops_csv(self.url) as csv_file:
+            rows = list(csv.reader(csv_file))
+
+        self.assertEqual(rows[0], ["email", "firstName", "notes"])
+        self.assertEqual(len(rows) - 1, row_count)
+        self.assertEqual(rows[-1], [f"user{row_count - 1}@example.com", f"Name {row_count - 1}", f"note, {row_count - 1}"])
+
+    def test_closes_response_on_http_error(self):
+        _CsvHandler.status = 403
+        _CsvHandler.body = b"AccessDenied"
+        responses = []
+        real_get = requests.get
+
+        def get(*args, **kwargs):
+            responses.append(real_get(*args, **kwargs))
+            return responses[-1]
+
+        with mock.patch.object(connector.requests, "get", side_effect=get):
+            with self.assertRaises(requests.HTTPError):
+                connector.download_loops_csv(self.url)
+
+        self.assertTrue(responses[0].raw.closed)
+
+
+class SessionTest(unittest.TestCase):
+    def test_does_not_store_response_cookies(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _CsvHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            connector._SESSION.get(f"http://127.0.0.1:{server.server_port}/").close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(len(connector._SESSION.cookies), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()